@@ -0,0 +1,15 @@
+import pandas as pd
+
+# One-time conversion of the cleaned CSV into Parquet, which the dashboard loads on start-up
+# (native datetime column, no text parsing). Re-run whenever clean_no2_long.csv changes.
+# Explicit dtypes: City as category (integer codes for isin/groupby), NO2 as 4-byte float.
+df = pd.read_csv(
+    "clean_no2_long.csv",
+    engine="pyarrow",
+    parse_dates=["month"],
+    dtype={"City": "category", "NO2": "float32"}
+)
+# Calendar columns stored too (int16/int8), so the dashboard does not derive them on every start
+df["year"] = df["month"].dt.year.astype("int16")
+df["month_num"] = df["month"].dt.month.astype("int8")
+df.to_parquet("clean_no2_long.parquet", engine="pyarrow", compression="zstd", index=False)
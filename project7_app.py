@@ -1,9 +1,15 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
+import plotly.io as pio
+import plotly.graph_objects as go
 import sklearn
+from sklearn.pipeline import Pipeline
+from sklearn.impute import SimpleImputer
+from sklearn.preprocessing import StandardScaler
 import joblib
 import numpy as np
+from collections import deque
 
 st.sidebar.write("⚙️ Streamlit sklearn version:", sklearn.__version__)
 
@@ -12,14 +18,187 @@ st.set_page_config(page_title="NO₂concentrations across European capital citie
 # --------------------------------------------------------
 # LOAD DATA
 # --------------------------------------------------------
-@st.cache_data
+MONTH_NAMES = {
+    1: "January", 2: "February", 3: "March", 4: "April",
+    5: "May", 6: "June", 7: "July", 8: "August",
+    9: "September", 10: "October", 11: "November", 12: "December"
+}
+# Inverse lookup for the Tab 2 month selectbox
+MONTH_NUMBERS = {name: num for num, name in MONTH_NAMES.items()}
+
+MONTH_SHORT = np.array(["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                        "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])
+
+SEASON_ORDER = ["Winter", "Spring", "Summer", "Autumn"]
+# Season by month number (index 0 unused)
+SEASON_BY_MONTH = np.array([
+    "", "Winter", "Winter", "Spring", "Spring", "Spring", "Summer",
+    "Summer", "Summer", "Autumn", "Autumn", "Autumn", "Winter"
+])
+
+# Read-only master frame: cache_resource shares one object across reruns and sessions
+# instead of hashing and copying the DataFrame on every cache hit.
+@st.cache_resource
 def load_data():
-    df = pd.read_csv("clean_no2_long.csv", parse_dates=["month"])
-    df["year"] = df["month"].dt.year
-    df["month_num"] = df["month"].dt.month
-    return df
+    # Parquet copy of clean_no2_long.csv (see csv_to_parquet.py): dates, categorical City,
+    # float32 NO2 and the year/month_num columns are stored natively
+    try:
+        df = pd.read_parquet("clean_no2_long.parquet", engine="pyarrow")
+    except FileNotFoundError:
+        # Parquet not generated yet — parse the CSV with the same dtypes
+        df = pd.read_csv(
+            "clean_no2_long.csv",
+            engine="pyarrow",
+            parse_dates=["month"],
+            dtype={"City": "category", "NO2": "float32"}
+        )
+        df["year"] = df["month"].dt.year.astype("int16")
+        df["month_num"] = df["month"].dt.month.astype("int8")
+    # Hover label via array lookup rather than a per-row strftime("%b")
+    df["month_short"] = MONTH_SHORT[df["month_num"].to_numpy() - 1]
+    # Season for Tab 4, derived once here; ordered categorical keeps Winter→Autumn order
+    df["season"] = pd.Categorical(
+        SEASON_BY_MONTH[df["month_num"].to_numpy()],
+        categories=SEASON_ORDER,
+        ordered=True
+    )
+
+    # Widget constants, returned with the frame so reruns never rescan City/year
+    all_cities = tuple(sorted(df["City"].unique().tolist()))
+    return df, all_cities, int(df["year"].min()), int(df["year"].max())
+
+df, all_cities, year_min, year_max = load_data()
+
+@st.cache_resource
+def index_by_city():
+    # Master frame sorted by (City, month) plus each city's [start, stop) row block: a city
+    # selection becomes a lookup of contiguous rows instead of an isin() scan over the frame
+    df_sorted = df.sort_values(["City", "month"]).reset_index(drop=True)
+    city_blocks = {
+        city: (rows[0], rows[-1] + 1)
+        for city, rows in df_sorted.groupby("City", observed=True).indices.items()
+    }
+    return df_sorted, city_blocks
+
+df_sorted, city_blocks = index_by_city()
+
+@st.cache_resource
+def monthly_pivot():
+    # month × City NO2 table (a few KB): one month across all cities is a single row lookup
+    return df.pivot(index="month", columns="City", values="NO2")
+
+no2_by_month = monthly_pivot()
+
+# --------------------------------------------------------
+# LOAD MODEL
+# --------------------------------------------------------
+# One deserialized pipeline per process, shared by all sessions and reruns
+@st.cache_resource
+def load_model():
+    model = joblib.load("no2_rf_pipeline.pkl")
+
+    # Throwaway predict so the first user forecast doesn't pay sklearn's first-call setup.
+    # Best effort only: a dummy row the pipeline rejects must not fail the model load
+    if hasattr(model, "feature_names_in_"):
+        warmup = pd.DataFrame([{c: 0 for c in model.feature_names_in_}])
+        if "City" in warmup.columns:
+            warmup["City"] = ""
+        try:
+            model.predict(warmup)
+        except Exception:
+            pass
+
+    return model
+
+LAG_FEATURES = ["NO2_prev_month", "NO2_roll3"]
+
+def encoded_lag_slots(preprocess):
+    # Column of each lag feature in the encoded matrix plus the StandardScaler mean/scale applied
+    # to it, so a new lag value can be written straight into an already-encoded row.
+    # None when the numeric branch is anything other than impute + scale.
+    try:
+        ct = preprocess[-1]
+        num_cols = list(next(cols for name, _, cols in ct.transformers_ if name == "num"))
+        num_steps = [step for _, step in ct.named_transformers_["num"].steps]
+        scaler = num_steps[-1]
+        if not (isinstance(scaler, StandardScaler) and scaler.with_mean and scaler.with_std):
+            return None
+        if not all(isinstance(step, SimpleImputer) for step in num_steps[:-1]):
+            return None
+
+        names = list(ct.get_feature_names_out())
+        slots = {}
+        for col in LAG_FEATURES:
+            i = num_cols.index(col)
+            slots[col] = (names.index(f"num__{col}"), scaler.mean_[i], scaler.scale_[i])
+        return slots
+    except (AttributeError, KeyError, TypeError, ValueError, StopIteration):
+        return None
+
+# Feature history used by the forecast tab, parsed once per process and sorted by
+# (City, month) so every city's rows are already in time order. Only the columns the tab
+# reads are parsed; NO2 values stay float64 because they are fed to the model as-is.
+@st.cache_resource
+def load_features():
+    df_feat = pd.read_csv(
+        "no2_with_features.csv",
+        engine="pyarrow",
+        usecols=["City", "month", "NO2", "NO2_roll3", "year", "month_num"],
+        parse_dates=["month"],
+        dtype={"City": "category", "year": "int16", "month_num": "int8"}
+    )
+    return df_feat.sort_values(["City", "month"]).reset_index(drop=True)
+
+# Forecast starting state of every city, built in one pass: the last observed row and the last
+# three NO2 values (oldest first) behind NO2_roll3. A city change is then a dict lookup.
+@st.cache_resource
+def last_states():
+    df_feat = load_features()
+    no2 = df_feat["NO2"].to_numpy(dtype=np.float64)
+    return {
+        city: (df_feat.iloc[rows[-1]], tuple(no2[rows[-3:]]))
+        for city, rows in df_feat.groupby("City", observed=True, sort=False).indices.items()
+    }
 
-df = load_data()
+# Options of the forecast city selectbox, sorted once; a tuple like all_cities
+@st.cache_resource
+def feature_cities():
+    return tuple(sorted(load_features()["City"].dropna().unique().tolist()))
+
+# --------------------------------------------------------
+# CACHED FILTERS
+# --------------------------------------------------------
+@st.cache_data
+def filter_time_series(cities, year_from, year_to):
+    # Keyed on a sorted tuple of cities, so reruns with an unchanged selection skip the scan
+    # Months are sorted within each city block, so the date window is two binary searches
+    start = pd.Timestamp(year_from, 1, 1).to_datetime64()
+    end = pd.Timestamp(year_to, 12, 31).to_datetime64()
+    months = df_sorted["month"].to_numpy()
+
+    rows = [np.empty(0, dtype=np.intp)]
+    for city in cities:
+        lo, hi = city_blocks[city]
+        first = lo + months[lo:hi].searchsorted(start, side="left")
+        last = lo + months[lo:hi].searchsorted(end, side="right")
+        rows.append(np.arange(first, last))
+
+    return df_sorted.iloc[np.concatenate(rows)].reset_index(drop=True)
+
+MAX_LINE_POINTS = 2000
+# Above this many points the Tab 1 lines are drawn without markers
+MAX_MARKER_POINTS = 500
+
+def downsample(df_t):
+    # Quarterly means per city: a quarter of the points Plotly has to serialize and draw
+    df_q = (
+        df_t.groupby(["City", pd.Grouper(key="month", freq="QS")], observed=True)["NO2"]
+        .mean()
+        .reset_index()
+    )
+    df_q["year"] = df_q["month"].dt.year
+    df_q["month_short"] = MONTH_SHORT[df_q["month"].dt.month.to_numpy() - 1]
+    return df_q
 
 st.title("🌍 European NO₂ Dashboard (2018–2025)")
 
@@ -32,7 +211,7 @@ tab1, tab2, tab3, tab4, tab5 = st.tabs([
     "📉 Correlation (Time vs NO₂)",
     "🍁 Seasonal Variation",
     "🔮 Forecasting Model"
-])
+], on_change="rerun")
 
 # ========================================================
 # TAB 1 — TIME SERIES
@@ -48,66 +227,77 @@ with tab1:
         "Tallinn (Estonia)"
     ]
 
-    other_cities = sorted([c for c in df["City"].unique() if c not in priority_cities])
+    other_cities = [c for c in all_cities if c not in priority_cities]
     ordered_cities = priority_cities + other_cities
 
-    cities = st.multiselect(
-        "Select cities:",
-        ordered_cities,
-        default=priority_cities
-    )
+    # Figure JSON is cached per selection, so unchanged reruns skip Plotly Express entirely
+    @st.cache_data
+    def build_time_fig(cities, year_from, year_to):
+        df_t = filter_time_series(cities, year_from, year_to)
+
+        downsampled = len(df_t) > MAX_LINE_POINTS
+        if downsampled:
+            df_t = downsample(df_t)
+
+        # COLOR MAP — EU27 ALWAYS RED
+        base_colors = px.colors.qualitative.Set2
+        color_map = {city: base_colors[i % len(base_colors)] for i, city in enumerate(ordered_cities)}
+        color_map["EU27 (aggregate)"] = "red"
+
+        # Hover order: EU27 first, then by each line's peak in the window; handed to Plotly Express
+        # so the traces are created in that order rather than re-sorted afterwards
+        city_max = df_t.groupby("City", observed=True)["NO2"].max().sort_values(ascending=False, kind="stable")
+        city_order = sorted(city_max.index, key=lambda c: c != "EU27 (aggregate)")
+
+        fig = px.line(
+            df_t,
+            x="month",
+            y="NO2",
+            color="City",
+            color_discrete_map=color_map,
+            category_orders={"City": city_order},
+            markers=len(df_t) <= MAX_MARKER_POINTS,
+            render_mode="webgl",  # scattergl traces: drawn on the GPU instead of as SVG nodes
+            hover_data={
+                "City": True,
+                "NO2": True,
+                "month_short": True,
+                "year": True,
+                "month": False
+            },
+            title="NO₂ Over Time (Selected Cities)"
+        )
 
-    years = st.slider("Select year range:", 2018, 2025, (2023, 2025))
-
-    df_t = df[
-        (df["City"].isin(cities)) &
-        (df["year"].between(years[0], years[1]))
-    ].copy()
-
-    df_t["month_short"] = df_t["month"].dt.strftime("%b")
-    df_t["year"] = df_t["month"].dt.year
-
-    # COLOR MAP — EU27 ALWAYS RED
-    base_colors = px.colors.qualitative.Set2
-    color_map = {city: base_colors[i % len(base_colors)] for i, city in enumerate(ordered_cities)}
-    color_map["EU27 (aggregate)"] = "red"
-
-    fig = px.line(
-        df_t,
-        x="month",
-        y="NO2",
-        color="City",
-        color_discrete_map=color_map,
-        markers=True,
-        hover_data={
-            "City": True,
-            "NO2": True,
-            "month_short": True,
-            "year": True,
-            "month": False
-        },
-        title="NO₂ Over Time (Selected Cities)"
-    )
+        fig.update_xaxes(tickformat="%b\n%Y", showgrid=True)
+        fig.update_yaxes(showgrid=True)
 
-    # SORT hover order
-    sorted_traces = sorted(
-        fig.data,
-        key=lambda t: (
-            0 if t.name == "EU27 (aggregate)" else 1,
-            -max(t.y)
+        fig.update_layout(
+            hovermode="x unified",
+            plot_bgcolor="white"
         )
-    )
-    fig.data = tuple(sorted_traces)
 
-    fig.update_xaxes(tickformat="%b\n%Y", showgrid=True)
-    fig.update_yaxes(showgrid=True)
+        return fig.to_json(), downsampled
 
-    fig.update_layout(
-        hovermode="x unified",
-        plot_bgcolor="white"
-    )
+    # Widget changes rerun only this fragment, not the other tabs
+    @st.fragment
+    def time_series_section():
+        cities = st.multiselect(
+            "Select cities:",
+            ordered_cities,
+            default=priority_cities
+        )
+
+        years = st.slider("Select year range:", year_min, year_max, (max(year_min, year_max - 2), year_max))
 
-    st.plotly_chart(fig, use_container_width=True)
+        fig_json, downsampled = build_time_fig(tuple(sorted(cities)), years[0], years[1])
+
+        if downsampled:
+            st.caption("Large selection — showing quarterly mean NO₂ values.")
+
+        # Stable keys: the chart element is updated in place across reruns, not recreated
+        st.plotly_chart(pio.from_json(fig_json), width="stretch", key="time_series_chart")
+
+    time_series_section()
 
 # ========================================================
 # TAB 2 — CITY MONTHLY LEVELS
@@ -115,49 +305,56 @@ with tab1:
 with tab2:
     st.header("🏙️ Monthly NO₂ Levels by European Capitals")
 
-    month_names = {
-        1: "January", 2: "February", 3: "March", 4: "April",
-        5: "May", 6: "June", 7: "July", 8: "August",
-        9: "September", 10: "October", 11: "November", 12: "December"
-    }
+    # Figure JSON cached per (year, month); reruns with the same selection reuse it
+    @st.cache_data
+    def build_levels_fig(selected_year, selected_month, month_title):
+        # Row of the precomputed pivot instead of masking the full frame by year and month
+        month_row = no2_by_month.reindex([pd.Timestamp(selected_year, selected_month, 1)]).iloc[0]
+        df_m = month_row.dropna().rename("NO2").rename_axis("City").reset_index()
 
-    selected_year = st.selectbox("Select Year:", sorted(df["year"].unique()), index=7)
+        eu_value = month_row.get("EU27 (aggregate)", np.nan)
 
-    selected_month_name = st.selectbox(
-        "Select Month:",
-        list(month_names.values()),
-        index=1
-    )
+        df_m = df_m.sort_values("NO2", ascending=False)
 
-    selected_month = [num for num, name in month_names.items() if name == selected_month_name][0]
+        fig2 = px.bar(
+            df_m,
+            x="City",
+            y="NO2",
+            color="NO2",
+            color_continuous_scale="RdYlGn_r",
+            title=f"NO₂ Levels by City — {month_title}"
+        )
+
+        fig2.add_hline(
+            y=eu_value,
+            line_dash="dash",
+            line_color="black",
+            annotation_text="EU27 average",
+            annotation_position="top left"
+        )
 
-    df_m = df[(df["year"] == selected_year) & (df["month_num"] == selected_month)].copy()
+        fig2.update_layout(xaxis_tickangle=-60)
+        return fig2.to_json()
 
-    eu_value = df_m[df_m["City"] == "EU27 (aggregate)"]["NO2"].mean()
+    @st.fragment
+    def monthly_levels_section():
+        year_options = list(range(year_min, year_max + 1))
+        selected_year = st.selectbox("Select Year:", year_options, index=len(year_options) - 1)
 
-    df_m = df_m.sort_values("NO2", ascending=False)
+        selected_month_name = st.selectbox(
+            "Select Month:",
+            list(MONTH_NAMES.values()),
+            index=1
+        )
 
-    month_title = selected_month_name + " " + str(selected_year)
+        selected_month = MONTH_NUMBERS[selected_month_name]
 
-    fig2 = px.bar(
-        df_m,
-        x="City",
-        y="NO2",
-        color="NO2",
-        color_continuous_scale="RdYlGn_r",
-        title=f"NO₂ Levels by City — {month_title}"
-    )
+        month_title = selected_month_name + " " + str(selected_year)
 
-    fig2.add_hline(
-        y=eu_value,
-        line_dash="dash",
-        line_color="black",
-        annotation_text="EU27 average",
-        annotation_position="top left"
-    )
+        fig2_json = build_levels_fig(selected_year, selected_month, month_title)
+        st.plotly_chart(pio.from_json(fig2_json), width="stretch", key="monthly_levels_chart")
 
-    fig2.update_layout(xaxis_tickangle=-60)
-    st.plotly_chart(fig2, use_container_width=True)
+    monthly_levels_section()
 
 # ========================================================
 # TAB 3 — CORRELATION
@@ -165,28 +362,39 @@ with tab2:
 with tab3:
     st.header("📉 Correlation Between Time and NO₂ (2018–2025)")
 
-    df_corr = df.copy()
-    df_corr["time_index"] = (df_corr["month"] - df_corr["month"].min()).dt.days
-
-    correlations = (
-        df_corr.groupby("City")[["time_index", "NO2"]]
-        .corr()
-        .iloc[0::2]["NO2"]
-        .reset_index()
-        .rename(columns={"NO2": "correlation"})
-    )
+    # No inputs: the figure is built once per process
+    @st.cache_data
+    def build_corr_fig():
+        # Pearson r per city from per-city sums, instead of a 2×2 corr() matrix per city.
+        # The sums are bincounts over the City category codes (one C pass each, no groupby)
+        x = (df["month"] - df["month"].min()).dt.days.to_numpy(dtype=np.float64)
+        y = df["NO2"].to_numpy(dtype=np.float64)
+        codes = df["City"].cat.codes.to_numpy()
+        k = len(df["City"].cat.categories)
+
+        n = np.bincount(codes, minlength=k)
+        sx, sy = np.bincount(codes, x, k), np.bincount(codes, y, k)
+        sxx, syy, sxy = np.bincount(codes, x * x, k), np.bincount(codes, y * y, k), np.bincount(codes, x * y, k)
+
+        observed = n > 0
+        correlations = pd.DataFrame({
+            "City": df["City"].cat.categories,
+            "correlation": (n * sxy - sx * sy) / np.sqrt((n * sxx - sx ** 2) * (n * syy - sy ** 2))
+        })[observed]
+
+        fig3 = px.bar(
+            correlations.sort_values("correlation"),
+            x="City",
+            y="correlation",
+            color="correlation",
+            color_continuous_scale="RdYlGn_r",
+            title="Correlation Between Time and NO₂ Concentration"
+        )
 
-    fig3 = px.bar(
-        correlations.sort_values("correlation"),
-        x="City",
-        y="correlation",
-        color="correlation",
-        color_continuous_scale="RdYlGn_r",
-        title="Correlation Between Time and NO₂ Concentration"
-    )
+        fig3.update_layout(xaxis_tickangle=-60)
+        return fig3.to_json()
 
-    fig3.update_layout(xaxis_tickangle=-60)
-    st.plotly_chart(fig3, use_container_width=True)
+    st.plotly_chart(pio.from_json(build_corr_fig()), width="stretch", key="correlation_chart")
 
 # ========================================================
 # TAB 4 — SEASONAL VARIATION
@@ -194,160 +402,246 @@ with tab3:
 with tab4:
     st.header("🍁 Seasonal Variation of NO₂ Concentration")
 
-    def assign_season(m):
-        if m in [12, 1, 2]:
-            return "Winter"
-        elif m in [3, 4, 5]:
-            return "Spring"
-        elif m in [6, 7, 8]:
-            return "Summer"
-        else:
-            return "Autumn"
-
-    df["season"] = df["month_num"].apply(assign_season)
-
-    season_colors = {
-        "Winter": "purple",
-        "Spring": "gold",
-        "Summer": "green",
-        "Autumn": "orange"
-    }
+    @st.cache_data
+    def build_season_fig():
+        season_colors = {
+            "Winter": "purple",
+            "Spring": "gold",
+            "Summer": "green",
+            "Autumn": "orange"
+        }
 
-    fig4 = px.box(
-        df,
-        x="season",
-        y="NO2",
-        color="season",
-        color_discrete_map=season_colors,
-        category_orders={"season": ["Winter", "Spring", "Summer", "Autumn"]},
-        hover_data={"City": True, "NO2": ":.2f", "season": True, "month_num": False},
-        title="Seasonal Variation of NO₂ Concentration in European Capitals"
-    )
+        # Box statistics computed here: the figure carries five numbers per season plus the
+        # points beyond the whiskers, instead of every NO2 value for the browser to summarise
+        fig4 = go.Figure()
+        for season, g in df.groupby("season", observed=True):
+            no2 = g["NO2"].to_numpy(dtype=np.float64)
+            # Hazen quartiles: the interpolation of plotly.js's default quartilemethod="linear"
+            q1, median, q3 = np.percentile(no2, [25, 50, 75], method="hazen")
+            iqr = q3 - q1
+            inside = (no2 >= q1 - 1.5 * iqr) & (no2 <= q3 + 1.5 * iqr)
+
+            fig4.add_trace(go.Box(
+                x=[season],
+                q1=[q1],
+                median=[median],
+                q3=[q3],
+                lowerfence=[no2[inside].min()],
+                upperfence=[no2[inside].max()],
+                name=season,
+                legendgroup=season,
+                marker_color=season_colors[season]
+            ))
+
+            # Outliers, with the city on hover
+            fig4.add_trace(go.Scatter(
+                x=[season] * int((~inside).sum()),
+                y=no2[~inside],
+                customdata=g["City"].to_numpy()[~inside],
+                mode="markers",
+                marker_color=season_colors[season],
+                hovertemplate="season=%{x}<br>NO2=%{y:.2f}<br>City=%{customdata}<extra></extra>",
+                legendgroup=season,
+                showlegend=False
+            ))
+
+        fig4.update_layout(
+            title="Seasonal Variation of NO₂ Concentration in European Capitals",
+            xaxis_title="season",
+            yaxis_title="NO2",
+            legend_title_text="season"
+        )
+        fig4.update_xaxes(categoryorder="array", categoryarray=SEASON_ORDER)
+        return fig4.to_json()
 
-    st.plotly_chart(fig4, use_container_width=True)
+    st.plotly_chart(pio.from_json(build_season_fig()), width="stretch", key="seasonal_chart")
 
 
 # ========================================================
 # TAB 5 — FORECASTING MODEL
 # ========================================================
 with tab5:
-    st.header("🔮 Forecasting Future NO₂ Concentrations")
-    st.write("This tab uses the trained Random Forest pipeline to forecast future monthly NO₂ values.")
-
-    # --- Load model ---
-    try:
-        model = joblib.load("no2_rf_pipeline.pkl")
-        st.success("Model loaded successfully!")
-    except Exception as e:
-        st.error(f"Model could not be loaded: {e}")
-        st.stop()
-
-    # --- Load feature dataset ---
-    try:
-        df_feat = pd.read_csv("no2_with_features.csv", parse_dates=["month"])
-    except Exception as e:
-        st.error(f"Could not load no2_with_features.csv — {e}")
-        st.stop()
+    # Fragment: the city/horizon widgets rerun only the forecast, not Tabs 1–4
+    @st.fragment
+    def forecast_section():
+        st.header("🔮 Forecasting Future NO₂ Concentrations")
+        st.write("This tab uses the trained Random Forest pipeline to forecast future monthly NO₂ values.")
 
-    # --- Basic validation ---
-    required_cols = {"City", "month", "NO2"}
-    if not required_cols.issubset(set(df_feat.columns)):
-        st.error("no2_with_features.csv is missing required columns (City, month, NO2).")
-        st.stop()
-
-    # --- UI ---
-    city = st.selectbox("Select a city for prediction:", sorted(df_feat["City"].dropna().unique()))
-    horizon = st.slider("Forecast horizon (months):", 1, 12, 6)
-
-    st.subheader(f"Forecasting next {horizon} months for **{city}**")
-
-    city_df = df_feat[df_feat["City"] == city].sort_values("month").copy()
-    if city_df.empty:
-        st.error("No data found for this city in no2_with_features.csv.")
-        st.stop()
-
-    last_row = city_df.iloc[-1]
+        # --- Load model ---
+        try:
+            model = load_model()
+            st.success("Model loaded successfully!")
+        except Exception as e:
+            st.error(f"Model could not be loaded: {e}")
+            st.stop()
 
-    # --- Starting state from last observed row ---
-    current_year = int(last_row.get("year", last_row["month"].year))
-    current_month_num = int(last_row.get("month_num", last_row["month"].month))
+        # --- Load feature dataset (a missing column already fails in read_csv) ---
+        try:
+            load_features()
+        except Exception as e:
+            st.error(f"Could not load no2_with_features.csv — {e}")
+            st.stop()
 
-    last_NO2 = float(last_row["NO2"])
-    last_prev = float(last_row.get("NO2_prev_month", last_NO2))
-    last_roll3 = float(last_row.get("NO2_roll3", last_NO2))
+        # --- UI ---
+        # The widgets are not rendered while another tab is open, so Streamlit drops their state.
+        # Their values are kept in plain session_state entries and copied back on every run.
+        city_options = feature_cities()
+        st.session_state.setdefault("forecast_city", city_options[0])
+        st.session_state.setdefault("forecast_horizon", 6)
+        st.session_state["_forecast_city"] = st.session_state["forecast_city"]
+        st.session_state["_forecast_horizon"] = st.session_state["forecast_horizon"]
+
+        def store_widget_value(key):
+            st.session_state[key] = st.session_state["_" + key]
+
+        city = st.selectbox(
+            "Select a city for prediction:",
+            city_options,
+            key="_forecast_city",
+            on_change=store_widget_value,
+            args=("forecast_city",)
+        )
+        horizon = st.slider(
+            "Forecast horizon (months):",
+            1, 12,
+            key="_forecast_horizon",
+            on_change=store_widget_value,
+            args=("forecast_horizon",)
+        )
 
-    # --- IMPORTANT: Use exact feature columns order expected by the model ---
-    if hasattr(model, "feature_names_in_"):
-        REQUIRED = list(model.feature_names_in_)
-    else:
-        REQUIRED = ["City", "season", "year", "month_num", "dayofyear", "NO2_prev_month", "NO2_roll3"]
-
-    preds = []
-    future_months = []
-
-    def month_to_season(m: int) -> int:
-        # 1=winter, 2=spring, 3=summer, 4=autumn
-        return (m % 12) // 3 + 1
-
-    for i in range(1, horizon + 1):
-        future_month_num = ((current_month_num - 1 + i) % 12) + 1
-        extra_years = (current_month_num - 1 + i) // 12
-        future_year = current_year + extra_years
-
-        day_of_year = int(pd.Timestamp(int(future_year), int(future_month_num), 15).day_of_year)
-        season_value = int(month_to_season(int(future_month_num)))
-
-        row = {
-            "City": str(city),
-            "season": int(season_value),
-            "year": int(future_year),
-            "month_num": int(future_month_num),
-            "dayofyear": int(day_of_year),
-            "NO2_prev_month": float(last_NO2),
-            "NO2_roll3": float(last_roll3),
-        }
+        st.subheader(f"Forecasting next {horizon} months for **{city}**")
 
-        # Correct order + only required columns
-        X = pd.DataFrame([[row.get(c, None) for c in REQUIRED]], columns=REQUIRED)
+        # The selectbox options and last_states() come from the same City groups of the feature frame
+        last_row, last_no2_values = last_states()[city]
 
-        # Force dtypes (helps sklearn transformers)
-        for col in ["season", "year", "month_num", "dayofyear"]:
-            if col in X.columns:
-                X[col] = pd.to_numeric(X[col], errors="coerce")
-        for col in ["NO2_prev_month", "NO2_roll3"]:
-            if col in X.columns:
-                X[col] = pd.to_numeric(X[col], errors="coerce")
-        if "City" in X.columns:
-            X["City"] = X["City"].astype(str)
+        # --- Starting state from last observed row ---
+        current_year = int(last_row["year"])
+        current_month_num = int(last_row["month_num"])
 
-        try:
-            y_pred = float(model.predict(X)[0])
-        except Exception as e:
-            st.error(f"Prediction failed: {e}")
-            st.write("Debug input row sent to model:")
-            st.dataframe(X, use_container_width=True)
-            st.stop()
+        last_NO2 = float(last_row["NO2"])
+        last_roll3 = float(last_row["NO2_roll3"])
 
-        preds.append(y_pred)
-        future_months.append(pd.Timestamp(int(future_year), int(future_month_num), 1).strftime("%b %Y"))
+        # Rolling window behind NO2_roll3: last three NO2 values (oldest first) and their sum
+        last_three = deque(last_no2_values, maxlen=3)
+        roll_sum = float(sum(last_three))
 
-        # Update rolling state for next step
-        last_roll3 = (last_roll3 * 3 - last_prev + y_pred) / 3.0
-        last_prev = last_NO2
-        last_NO2 = y_pred
+        # --- IMPORTANT: Use exact feature columns order expected by the model ---
+        if hasattr(model, "feature_names_in_"):
+            REQUIRED = list(model.feature_names_in_)
+        else:
+            REQUIRED = ["City", "season", "year", "month_num", "dayofyear", "NO2_prev_month", "NO2_roll3"]
 
-    forecast_df = pd.DataFrame({"Month": future_months, "Predicted NO2": preds})
+        # --- Calendar features for the whole horizon, computed once (month starts) ---
+        future_index = pd.date_range(
+            pd.Timestamp(current_year, current_month_num, 1) + pd.offsets.MonthBegin(1),
+            periods=horizon,
+            freq="MS"
+        )
+        future_years = future_index.year.to_numpy()
+        future_month_nums = future_index.month.to_numpy()
+        future_doys = (future_index + pd.Timedelta(days=14)).dayofyear.to_numpy()  # mid-month
+        future_seasons = (future_month_nums % 12) // 3 + 1  # 1=winter, 2=spring, 3=summer, 4=autumn
+
+        # Forecasts already computed in this session, by (city, horizon): going back to an
+        # earlier selection re-renders without running the model again
+        forecasts = st.session_state.setdefault("forecasts", {})
+        forecast_key = (city, horizon)
+
+        if forecast_key not in forecasts:
+            # All horizon rows in one frame, in the model's column order. Columns come straight from
+            # plain int64/float64 arrays, so nothing needs coercing; the loop only writes the two
+            # lag cells of the current step.
+            X_all = pd.DataFrame(
+                {
+                    "City": [str(city)] * horizon,
+                    "season": future_seasons.astype(np.int64),
+                    "year": future_years.astype(np.int64),
+                    "month_num": future_month_nums.astype(np.int64),
+                    "dayofyear": future_doys.astype(np.int64),
+                    "NO2_prev_month": np.full(horizon, last_NO2),
+                    "NO2_roll3": np.full(horizon, last_roll3),
+                },
+                columns=REQUIRED
+            )
+
+            lag_pos = {c: X_all.columns.get_loc(c) for c in LAG_FEATURES if c in X_all.columns}
+
+            # Preprocessor and forest called separately: the forest gets the encoded matrix directly
+            if isinstance(model, Pipeline):
+                preprocess, estimator = model[:-1], model[-1]
+            else:
+                preprocess, estimator = None, model
+
+            # City, season and the calendar are known for every step, so the whole horizon is encoded
+            # in one transform; per step only the two (scaled) lag columns are overwritten
+            lag_slots = encoded_lag_slots(preprocess) if preprocess is not None else None
+
+            # Skip sklearn's per-call NaN/inf scan on every step. sklearn's config is thread-local and
+            # fragment reruns run on their own thread, so it is set here rather than at import
+            with sklearn.config_context(assume_finite=True):
+                # Inputs validated once, before the loop: the whole horizon goes through the preprocessor
+                # (where column/dtype problems surface), or one predict for a bare estimator
+                try:
+                    if preprocess is not None:
+                        encoded = preprocess.transform(X_all)
+                        if hasattr(encoded, "toarray"):
+                            encoded = encoded.toarray()
+                        encoded = np.asarray(encoded, dtype=np.float64)
+                    else:
+                        estimator.predict(X_all.iloc[[0]])
+                except Exception as e:
+                    st.error(f"Prediction failed: {e}")
+                    st.write("Debug input row sent to model:")
+                    st.dataframe(X_all.iloc[[0]], width="stretch")
+                    st.stop()
+
+                preds = np.empty(horizon, dtype=np.float64)
+
+                for i in range(horizon):
+                    if lag_slots is not None:
+                        X_in = encoded[i:i + 1]
+                        for col, value in zip(LAG_FEATURES, (last_NO2, last_roll3)):
+                            pos, mean, scale = lag_slots[col]
+                            X_in[0, pos] = (value - mean) / scale
+                    else:
+                        for col, value in zip(LAG_FEATURES, (last_NO2, last_roll3)):
+                            if col in lag_pos:
+                                X_all.iat[i, lag_pos[col]] = value
+                        X_row = X_all.iloc[[i]]
+                        X_in = preprocess.transform(X_row) if preprocess is not None else X_row
+
+                    y_pred = float(estimator.predict(X_in)[0])
+                    preds[i] = y_pred
+
+                    # Update rolling state for next step: the prediction enters the window, the oldest leaves
+                    left = last_three[0] if len(last_three) == last_three.maxlen else 0.0
+                    roll_sum += y_pred - left
+                    last_three.append(y_pred)
+                    last_roll3 = roll_sum / len(last_three)
+                    last_NO2 = y_pred
+
+            forecasts[forecast_key] = preds
+
+        preds = forecasts[forecast_key]
+
+        # Month labels formatted once for the whole horizon
+        future_months = future_index.strftime("%b %Y")
+        forecast_df = pd.DataFrame({"Month": future_months, "Predicted NO2": preds})
+
+        # 1) Chart FIRST — one trace straight from the label/prediction arrays
+        fig5 = go.Figure(go.Scatter(x=future_months, y=preds, mode="lines+markers"))
+        fig5.update_layout(
+            title=f"Forecasted NO₂ for {city}",
+            xaxis_title="Month",
+            yaxis_title="Predicted NO2"
+        )
+        st.plotly_chart(fig5, width="stretch", key="forecast_chart")
 
-    # 1) Chart FIRST
-    fig5 = px.line(
-        forecast_df,
-        x="Month",
-        y="Predicted NO2",
-        markers=True,
-        title=f"Forecasted NO₂ for {city}"
-    )
-    st.plotly_chart(fig5, use_container_width=True)
+        # 2) Table AFTER
+        st.write("### 📅 Forecast Table")
+        st.dataframe(forecast_df, width="stretch")
 
-    # 2) Table AFTER
-    st.write("### 📅 Forecast Table")
-    st.dataframe(forecast_df, use_container_width=True)
+    # Tabs rerun on selection (on_change="rerun"), so the model and feature data are only
+    # loaded once this tab is actually opened
+    if tab5.open:
+        forecast_section()